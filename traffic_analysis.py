@@ -1,8 +1,20 @@
 import argparse
+import os
+from functools import lru_cache
 import networkx as nx
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import minimize, Bounds, LinearConstraint
+from scipy.sparse import csr_matrix
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to plain python if it isn't installed
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 
 def parse_args():
@@ -12,6 +24,16 @@ def parse_args():
     parser.add_argument("start", type=int, help="Start node")
     parser.add_argument("end", type=int, help="End node")
     parser.add_argument("--plot", action="store_true", help="Plot the graph")
+    # the two ways of limiting the paths can't be combined
+    paths_group = parser.add_mutually_exclusive_group()
+    paths_group.add_argument("--max-hops", type=int, default=None,
+                             help="Only use paths with at most this many edges")
+    paths_group.add_argument("--path-tol", type=int, default=None,
+                             help="Only use the shortest paths plus those at most this many edges longer")
+    parser.add_argument("--precision", choices=["f32", "f64"], default="f64",
+                        help="Float precision of the stored edge and path arrays")
+    parser.add_argument("--cache", action="store_true",
+                        help="Load the graph from <gml_file>.npz, creating it from the GML file on the first run")
     return parser.parse_args()
 
 
@@ -26,65 +48,287 @@ def load_graph(path):
         exit(1)
 
 
-def get_all_paths(G, start, end):
-    return list(nx.all_simple_paths(G, source=start, target=end))
+# renumber nodes 0..V-1 once and keep the original label in 'orig'. read_gml gives numeric labels as ints and
+# quoted ones as strings, so labels are normalised to str to match the start/end lookup
+def relabel_nodes(G):
+    G = nx.convert_node_labels_to_integers(G, label_attribute="orig")
+    for i in G.nodes:
+        G.nodes[i]["orig"] = str(G.nodes[i]["orig"])
+    orig_to_int = {G.nodes[i]["orig"]: i for i in G.nodes}
+    return G, orig_to_int
+
+
+# csr adjacency, the out neighbours of node u are indices[indptr[u]:indptr[u + 1]]
+def build_csr(G):
+    V = G.number_of_nodes()
+    indptr = np.zeros(V + 1, dtype=np.int32)
+    indices = np.empty(G.number_of_edges(), dtype=np.int32)
+    k = 0
+    for u in range(V):
+        for _, v in G.out_edges(u):
+            indices[k] = v
+            k += 1
+        indptr[u + 1] = k
+    return indptr, indices
+
+
+# number every edge by its position in the csr arrays
+def number_edges(indptr, indices):
+    sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    edges = list(zip(sources.tolist(), indices.tolist()))
+    edge_index = {e: i for i, e in enumerate(edges)}
+    return edges, edge_index
+
+
+# read every edge's a, b coefficients once, so later code indexes arrays by edge id instead of looking up
+# G[u][v] attribute dicts
+def get_edge_arrays(G, indptr, indices, dtype=np.float64):
+    edges, edge_index = number_edges(indptr, indices)
+    a_arr = np.array([G[u][v].get("a", 0) for u, v in edges], dtype=dtype)
+    b_arr = np.array([G[u][v].get("b", 0) for u, v in edges], dtype=dtype)
+    return edges, a_arr, b_arr, edge_index
+
+
+# read_gml is slow, so for repeated runs parse the GML once and save the edges as arrays in <path>.npz.
+# later runs load the arrays and build the csr adjacency and graph straight from them. if the GML file is gone
+# the existing cache is used as is
+def cache_graph(path):
+    cache = path + ".npz"
+    if not os.path.exists(cache) or (os.path.exists(path) and os.path.getmtime(cache) < os.path.getmtime(path)):
+        G, orig_to_int = relabel_nodes(load_graph(path))
+        indptr, indices = build_csr(G)
+        edges, a_arr, b_arr, _ = get_edge_arrays(G, indptr, indices)
+        src = np.array([u for u, _ in edges], dtype=np.int32)
+        labels = np.array(list(orig_to_int))
+        with open(cache, "wb") as f:
+            np.savez(f, labels=labels, src=src, dst=indices, a=a_arr, b=b_arr)
+
+    with np.load(cache) as data:
+        labels = data["labels"].tolist()
+        src, dst, a_arr, b_arr = data["src"], data["dst"], data["a"], data["b"]
+    # edges were saved in csr order, so counting the edges out of each node gives indptr
+    indptr = np.zeros(len(labels) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=len(labels)))
+    indices = dst.astype(np.int32)
+
+    # path enumeration and plotting still work on a networkx graph, but building it from the arrays is cheap
+    G = nx.DiGraph()
+    G.add_nodes_from((i, {"orig": label}) for i, label in enumerate(labels))
+    G.add_edges_from(zip(src.tolist(), dst.tolist()))
+    orig_to_int = {label: i for i, label in enumerate(labels)}
+    return G, orig_to_int, indptr, indices, a_arr, b_arr
+
+
+# hop distance from start to every node and from every node to end, cached so repeated queries on the
+# same graph reuse the BFS. the cache is keyed on the graph object, so G must not be modified after the first
+# call, and it only keeps the last few queries so old graphs aren't kept alive
+@lru_cache(maxsize=32)
+def get_hop_distances(G, start, end):
+    sd_s = nx.single_source_shortest_path_length(G, start)
+    sd_t = nx.single_source_shortest_path_length(G.reverse(copy=False), end)
+    return sd_s, sd_t
+
+
+# paths are yielded one at a time so callers can stream them instead of holding every path in memory
+def get_all_paths(G, start, end, max_hops=None):
+    if max_hops is None:
+        yield from nx.all_simple_paths(G, source=start, target=end)
+        return
+    # a node can only be on a path of at most max_hops edges if getting there from start plus getting from it
+    # to end fits in max_hops, so drop every other node before enumerating
+    sd_s, sd_t = get_hop_distances(G, start, end)
+    valid = [v for v in G if sd_s.get(v, np.inf) + sd_t.get(v, np.inf) <= max_hops]
+    if start not in valid:
+        return
+    yield from nx.all_simple_paths(G.subgraph(valid), source=start, target=end, cutoff=max_hops)
 
 
-# distribute vechicles across multiple paths from a source to a destination, so total cost across whole
-# network is minimized
-def assign_flow_social_optimum(G, paths, n):
-    # compute the total system cost given proposed distrubution
-    def total_cost(flow_split):
-        # initalize flow on every edge to 0
-        edge_flows = {(u, v): 0 for u, v in G.edges()}
-        # loop through each path and proposed flow
-        for f, path in zip(flow_split, paths):
-            for i in range(len(path) - 1):
-                # for each edge in path add flow to that edge's total flow
-                u, v = path[i], path[i + 1]
-                edge_flows[(u, v)] += f
-        total = 0
-        # compute total system cost
-        # each edge gets flow x
-        for (u, v), x in edge_flows.items():
-            a = G[u][v].get("a", 0)
-            b = G[u][v].get("b", 0)
-            # copmpute edge cost per vehicle and multiply by total flow
-            total += x * (a * x + b)
-        return total
+# shortest_simple_paths yields paths in order of length, so stop as soon as one is more than tol edges
+# longer than the shortest instead of walking every longer path
+def get_shortest_paths(G, start, end, tol=0):
+    shortest = None
+    try:
+        for path in nx.shortest_simple_paths(G, start, end):
+            if shortest is None:
+                shortest = len(path)
+            elif len(path) > shortest + tol:
+                return
+            yield path
+    except nx.NetworkXNoPath:
+        return
 
-    # create inital guess
-    x0 = np.ones(len(paths)) * (n/len(paths))
-    # create bounds so no path can have more than n cars
-    bounds = [(0, n)] * len(paths)
-    # sum of all paths must equal n vechiles
-    cons = ({'type': 'eq', 'fun': lambda x: sum(x) - n})
-    # use minimize to find path flows that minimize total cost
-    res = minimize(total_cost, x0, bounds=bounds, constraints=cons)
-    return res.x if res.success else None
 
+# flatten paths into edge indices plus offsets marking where each path starts. paths can be a generator,
+# each path is consumed as it comes so only the flat edge indices are kept
+def flatten_paths(paths, edge_index):
+    path_edge_idx = []
+    path_offsets = [0]
+    for path in paths:
+        for i in range(len(path) - 1):
+            path_edge_idx.append(edge_index[(path[i], path[i + 1])])
+        path_offsets.append(len(path_edge_idx))
+    return np.array(path_edge_idx, dtype=np.int32), np.array(path_offsets, dtype=np.int32)
 
-def assign_flows_nash_equilibrium(G, paths, n):
-    # Placeholder: simple equal distribution as approximation
-    return np.ones(len(paths)) * (n / len(paths))
 
+# path-edge incidence matrix, M[p, e] = 1 if edge e is on path p. built once and shared by the solvers and
+# reporting, stored sparse so it takes as much memory as the flattened paths
+def build_incidence(path_edge_idx, path_offsets, E, dtype=np.float64):
+    P = len(path_offsets) - 1
+    rows = np.repeat(np.arange(P), np.diff(path_offsets))
+    return csr_matrix((np.ones(len(path_edge_idx), dtype=dtype), (rows, path_edge_idx)), shape=(P, E))
 
-def flows_to_edge_flows(G, paths, flows):
-    edge_flows = {(u, v): 0 for u, v in G.edges()}
-    for f, path in zip(flows, paths):
-        for i in range(len(path) - 1):
-            u, v = path[i], path[i + 1]
-            edge_flows[(u, v)] += f
-    return edge_flows
 
+# with edge flows x = M.T @ f, the total system cost summing x * (a*x + b) over edges is a convex quadratic in the
+# path flows. build its matrix Q = M diag(a) M.T and vector c = M b once
+def build_path_costs(M, a_arr, b_arr):
+    Q = (M @ (M.T.multiply(a_arr[:, None]))).toarray()
+    c = M @ b_arr
+    return Q, c
+
+
+# minimize f.T @ Q @ f + c @ f over path flows f with 0 <= f <= n and sum(f) = n
+def solve_path_qp(Q, c, n, x0):
+    # Q and c may be stored in float32 (--precision f32), the solver works in float64
+    Q = Q.astype(np.float64)
+    c = c.astype(np.float64)
+    # hessian, computed once so grad and hess don't build a new P x P array on every call
+    Q2 = 2 * Q
+
+    def cost(flow_split):
+        return flow_split @ Q @ flow_split + c @ flow_split
+
+    def grad(flow_split):
+        return Q2 @ flow_split + c
 
-def print_flows(title, edge_flows):
+    def hess(flow_split):
+        return Q2
+
+    P = len(c)
+    # create bounds so no path can have more than n cars
+    bounds = Bounds(0, n)
+    # sum of all paths must equal n vechiles
+    cons = LinearConstraint(np.ones((1, P)), n, n)
+    # with the exact hessian trust-constr only needs a handful of iterations
+    res = minimize(cost, x0, method='trust-constr', jac=grad, hess=hess, bounds=bounds, constraints=cons)
+    if res.success:
+        return res.x
+    # trust-constr can't handle a singular Q, e.g. when a = 0 on every edge and the problem is linear, so fall
+    # back to the active set SLSQP with the same analytic gradients
+    cons = {'type': 'eq', 'fun': lambda x: x.sum() - n, 'jac': lambda x: np.ones_like(x)}
+    res = minimize(cost, x0, method='SLSQP', jac=grad, bounds=[(0, n)] * P, constraints=cons)
+    return res.x if res.success else None
+
+
+# distribute vechicles across multiple paths from a source to a destination, so total cost across whole
+# network is minimized
+def assign_flow_social_optimum(Q, c, n):
+    P = len(c)
+    # create inital guess
+    x0 = np.ones(P) * (n/P)
+    # the total system cost sums x * (a*x + b) over edges, which is f.T @ Q @ f + c @ f
+    return solve_path_qp(Q, c, n, x0)
+
+
+# frank-wolfe on the beckmann potential sum over edges of (a/2 * x^2 + b * x), whose minimum is the
+# point where no driver can switch to a faster path. returns the path flows and whether it converged
+@njit(cache=True)
+def _frank_wolfe(path_edge_idx, path_offsets, n, a_arr, b_arr, max_iter, tol):
+    P = len(path_offsets) - 1
+    E = len(a_arr)
+    # start from an equal distribution across paths
+    flows = np.full(P, n / P)
+    edge_flows = np.zeros(E)
+    for p in range(P):
+        for k in range(path_offsets[p], path_offsets[p + 1]):
+            edge_flows[path_edge_idx[k]] += flows[p]
+    path_times = np.zeros(P)
+    direction = np.zeros(E)
+    for _ in range(max_iter):
+        # travel time on every path at the current flows
+        travel_times = a_arr * edge_flows + b_arr
+        for p in range(P):
+            t = 0.0
+            for k in range(path_offsets[p], path_offsets[p + 1]):
+                t += travel_times[path_edge_idx[k]]
+            path_times[p] = t
+        best = np.argmin(path_times)
+        # stop once the used paths are (almost) no slower than the fastest one
+        total_time = flows @ path_times
+        if total_time - n * path_times[best] <= tol * total_time:
+            return flows, True
+        # slowest path still carrying flow
+        worst = best
+        for p in range(P):
+            if flows[p] > 0 and path_times[p] > path_times[worst]:
+                worst = p
+        # all or nothing moves every vehicle towards the fastest path. when taking vehicles off the slowest used
+        # path gains more (an away step) do that instead, otherwise plain frank-wolfe zigzags near the optimum
+        # and takes tens of thousands of iterations
+        away = n * path_times[worst] - total_time > total_time - n * path_times[best] and flows[worst] < n
+        # edge direction, target - edge_flows for all or nothing, edge_flows - target for an away step
+        target = worst if away else best
+        direction[:] = -edge_flows if not away else edge_flows
+        sign = -1.0 if away else 1.0
+        for k in range(path_offsets[target], path_offsets[target + 1]):
+            direction[path_edge_idx[k]] += sign * n
+        # an away step can only go until the slowest path is empty
+        max_step = flows[worst] / (n - flows[worst]) if away else 1.0
+        # exact line search, the potential is quadratic along the direction
+        slope = travel_times @ direction
+        curvature = (a_arr * direction) @ direction
+        if curvature > 0:
+            step = min(max(-slope / curvature, 0.0), max_step)
+        else:
+            step = max_step if slope < 0 else 0.0
+        if step == 0.0:
+            return flows, False
+        if away:
+            flows *= 1 + step
+            flows[worst] -= step * n
+            flows[worst] = max(flows[worst], 0.0)
+        else:
+            flows *= 1 - step
+            flows[best] += step * n
+        edge_flows += step * direction
+    return flows, False
+
+
+# wardrop (nash) equilibrium, where no driver can switch to a faster path. returns None if frank-wolfe doesn't
+# converge within max_iter
+def assign_flows_nash_equilibrium(path_edge_idx, path_offsets, n, a_arr, b_arr, max_iter=10000, tol=1e-6):
+    # the edge coefficients may be stored in float32 (--precision f32), frank-wolfe works in float64
+    flows, converged = _frank_wolfe(path_edge_idx, path_offsets, float(n), a_arr.astype(np.float64),
+                                    b_arr.astype(np.float64), max_iter, tol)
+    return flows if converged else None
+
+
+# one sparse matrix-vector product adds every path's flow onto its edges
+def flows_to_edge_flows(M, flows):
+    return M.T.dot(flows)
+
+
+# {(u, v): flow} form of the edge flows, only for printing, not used by the solvers
+def edge_flows_to_dict(edge_flows, edges):
+    return dict(zip(edges, edge_flows.tolist()))
+
+
+# per edge travel time a*x + b and potential x * (a*x + b), plus the total cost, computed once per flow set and
+# shared by printing, plotting and the cost reporting
+def edge_stats(edge_flows, a_arr, b_arr):
+    travel_time = a_arr * edge_flows + b_arr
+    potential = edge_flows * travel_time
+    return travel_time, potential, float(potential.sum())
+
+
+def print_flows(title, edge_flows, edges, labels, stats):
     print(f"\n{title}")
-    for (u, v), f in edge_flows.items():
-        print(f"Edge ({u} -> {v}: {f:.2f} vehicles")
+    for (u, v), f in edge_flows_to_dict(edge_flows, edges).items():
+        print(f"Edge ({labels[u]} -> {labels[v]}: {f:.2f} vehicles")
+    print(f"Social cost: {stats[2]:.2f}")
 
 
-def plot_graph(G, edge_flows, title="Graph", social_cost=None, potential_power=None, start=None, end=None):
+# stats is the (travel_time, potential, total_cost) tuple from edge_stats()
+def plot_graph(G, edge_flows, a_arr, b_arr, edges, stats, title="Graph", start=None, end=None):
     nodes = list(G.nodes())
     middle_nodes = [n for n in nodes if n != start and n != end]
     ordered_nodes = [start] + sorted(middle_nodes) + [end]
@@ -101,35 +345,28 @@ def plot_graph(G, edge_flows, title="Graph", social_cost=None, potential_power=N
     pos[end] = ((len(ordered_nodes) - 1) * x_spacing, 0)
 
     plt.figure(figsize=(10, 5))
-    nx.draw(G, pos, with_labels=True, node_size=1000, node_color='steelblue', font_color='white', arrows=True)
+    nx.draw(G, pos, labels=nx.get_node_attributes(G, "orig"), node_size=1000, node_color='steelblue',
+            font_color='white', arrows=True)
 
-    edge_labels = {}
-    total_potential = 0
-    for (u, v) in G.edges():
-        a = G[u][v].get("a", 0)
-        b = G[u][v].get("b", 0)
-        x = edge_flows.get((u, v), 0)
-        travel_time = a * x + b
-        potential = x * travel_time
-        total_potential += potential
+    # edges are in edge id order, the same order as the stats arrays
+    travel_time, potential, total_cost = stats
 
-        label = f"{a}x + {b}, Drivers {x:.0f}\nTravel Time {travel_time:.0f}\nPotential Power {int(potential)}"
-        edge_labels[(u, v)] = label
+    edge_labels = {
+        (u, v): f"{a:g}x + {b:g}, Drivers {x:.0f}\nTravel Time {t:.0f}\nPotential Power {int(p)}"
+        for (u, v), a, b, x, t, p in zip(edges, a_arr, b_arr, edge_flows, travel_time, potential)
+    }
 
     nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_color='red', font_size=9)
 
     # Add total cost as text
     info_lines = []
-    if title is "Nash Equilibrium":
+    if title == "Nash Equilibrium":
         info_lines.append(f"Nash equilibrium")
-    if title is "Social Optimum":
+    if title == "Social Optimum":
         info_lines.append(f"Social Optimum")
-    if social_cost is not None:
-        info_lines.append(f"Social Cost {int(social_cost)}")
-    if potential_power is not None:
-        info_lines.append(f"Potential power {int(potential_power)}")
-    elif total_potential:
-        info_lines.append(f"Potential power {int(total_potential)}")
+    # the total potential power of the edges is the social cost
+    info_lines.append(f"Social Cost {int(total_cost)}")
+    info_lines.append(f"Potential power {int(total_cost)}")
 
     plt.text(0.05, 0.01, "\n".join(info_lines), transform=plt.gca().transAxes, fontsize=10, color='black')
     plt.title(title)
@@ -137,49 +374,63 @@ def plot_graph(G, edge_flows, title="Graph", social_cost=None, potential_power=N
     plt.show()
 
 
-def compute_social_cost(edge_flows, G):
-    total = 0
-    for (u, v), x in edge_flows.items():
-        a = G[u][v].get("a", 0)
-        b = G[u][v].get("b", 0)
-        total += x * (a * x + b)
-    return total
-
-
 def main():
     args = parse_args()
-    G = load_graph(args.gml_file)
-
-    start = str(args.start)
-    end = str(args.end)
-
-    print("graph nodes:", G.nodes)
-    paths = get_all_paths(G, start, end)
-    if not paths:
+    dtype = np.float32 if args.precision == "f32" else np.float64
+    if args.cache:
+        G, orig_to_int, indptr, indices, a_arr, b_arr = cache_graph(args.gml_file)
+        edges, edge_index = number_edges(indptr, indices)
+        a_arr = a_arr.astype(dtype)
+        b_arr = b_arr.astype(dtype)
+    else:
+        G = load_graph(args.gml_file)
+        G, orig_to_int = relabel_nodes(G)
+        indptr, indices = build_csr(G)
+        edges, a_arr, b_arr, edge_index = get_edge_arrays(G, indptr, indices, dtype)
+    labels = list(orig_to_int)
+
+    print("graph nodes:", labels)
+    if str(args.start) not in orig_to_int or str(args.end) not in orig_to_int:
+        print("Start or end node not in graph")
+        return
+    start = orig_to_int[str(args.start)]
+    end = orig_to_int[str(args.end)]
+
+    if args.path_tol is not None:
+        paths = get_shortest_paths(G, start, end, args.path_tol)
+    else:
+        paths = get_all_paths(G, start, end, args.max_hops)
+    path_edge_idx, path_offsets = flatten_paths(paths, edge_index)
+    if len(path_offsets) == 1:
         print("No path found")
         return
 
     n = args.vehicles
+    M = build_incidence(path_edge_idx, path_offsets, len(edges), dtype)
+    Q, c = build_path_costs(M, a_arr, b_arr)
 
     # compute Nash and optimal flows
-    # nash find equal distribution
-    nash_flows = assign_flows_nash_equilibrium(G, paths, n)
+    # nash where no driver can do better by switching path
+    nash_flows = assign_flows_nash_equilibrium(path_edge_idx, path_offsets, n, a_arr, b_arr)
     # social optimization
-    opt_flows = assign_flow_social_optimum(G, paths, n)
-
-    # converts path level flows to edge level flows
-    nash_edge_flows = flows_to_edge_flows(G, paths, nash_flows)
-    opt_edge_flows = flows_to_edge_flows(G, paths, opt_flows)
-
-    # print results
-    print_flows("Nash Equilibrium", nash_edge_flows)
-    print_flows("Social Optimum", opt_edge_flows)
+    opt_flows = assign_flow_social_optimum(Q, c, n)
+
+    results = []
+    for title, flows in (("Nash Equilibrium", nash_flows), ("Social Optimum", opt_flows)):
+        # report a solver that failed but still show the other result
+        if flows is None:
+            print(f"\n{title}\nSolver did not converge")
+            continue
+        # converts path level flows to edge level flows
+        edge_flows = flows_to_edge_flows(M, flows)
+        stats = edge_stats(edge_flows, a_arr, b_arr)
+        # print results
+        print_flows(title, edge_flows, edges, labels, stats)
+        results.append((title, edge_flows, stats))
 
     if args.plot:
-        plot_graph(G, nash_edge_flows, title="Nash Equilibrium", social_cost=compute_social_cost(nash_edge_flows, G),
-                   start=start, end=end)
-        plot_graph(G, opt_edge_flows, title="Social Optimum", social_cost=compute_social_cost(opt_edge_flows, G),
-                   start=start, end=end)
+        for title, edge_flows, stats in results:
+            plot_graph(G, edge_flows, a_arr, b_arr, edges, stats, title=title, start=start, end=end)
 
 
 if __name__ == "__main__":